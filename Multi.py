@@ -10,7 +10,8 @@ app.py – Générateur PF1 → PF6 (Multiconnexion) + Export Outlook
 """
 
 from __future__ import annotations
-import io, re, sys, tempfile, os
+import re, sys, tempfile, os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
 
@@ -18,13 +19,35 @@ import pandas as pd
 import streamlit as st
 
 # ═══════════ libpostal (optionnel) ═══════════
+@st.cache_resource(show_spinner=False)
+def _addr_parser():
+    # modèle CRF chargé une fois par process, partagé par toutes les sessions
+    from postal.parser import parse_address  # type: ignore
+    return parse_address
+
 USE_POSTAL = False
 try:
-    from postal.parser import parse_address  # type: ignore
+    parse_address = _addr_parser()
     USE_POSTAL = True
 except ImportError:
     pass  # on continue en regex
 
+# ═══════════ python-calamine (optionnel) ═══════════
+USE_CALAMINE = False
+try:
+    import python_calamine  # type: ignore  # noqa: F401
+    USE_CALAMINE = True
+except ImportError:
+    pass  # lecture Excel via openpyxl
+
+# ═══════════ xlsxwriter (optionnel) ═══════════
+USE_XLSXWRITER = False
+try:
+    import xlsxwriter  # type: ignore
+    USE_XLSXWRITER = True
+except ImportError:
+    pass  # on écrit en openpyxl write_only
+
 # ═══════════ Outlook (optionnel) ═══════════
 IS_OUTLOOK = False
 try:
@@ -44,8 +67,45 @@ st.markdown(
     "Colonnes requises : **Numéro de compte** (7 chiffres), **Raison sociale**, **Adresse**, **ManagingBranch** (4 chiffres)."
 )
 
+# ═══════════ EXPORT XLSX ═══════════
+# valeurs brutes : pas de détection d'URL / formule sur chaque cellule texte
+# format date explicite : sans lui xlsxwriter écrit les dates en numéro de série (45296)
+XLSX_OPTIONS = {"constant_memory": True, "strings_to_urls": False, "strings_to_formulas": False,
+                "default_date_format": "yyyy-mm-dd"}
+
+def _sheet_rows(df: pd.DataFrame):
+    # en-tête puis lignes, manquants → None (cellule vide)
+    yield list(df.columns)
+    yield from df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+def to_xlsx_book(sheets: dict[str, pd.DataFrame]) -> bytes:
+    # écriture ligne à ligne sans passer par le formateur pandas (styles par cellule)
+    buf = BytesIO()
+    if USE_XLSXWRITER:
+        wb = xlsxwriter.Workbook(buf, XLSX_OPTIONS)
+        for name, df in sheets.items():
+            ws = wb.add_worksheet(name)
+            for i, row in enumerate(_sheet_rows(df)):
+                ws.write_row(i, 0, row)
+        wb.close()
+    else:
+        # openpyxl en write_only : lignes streamées, aucun objet Cell conservé
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        for name, df in sheets.items():
+            ws = wb.create_sheet(name)
+            for row in _sheet_rows(df):
+                ws.append(row)
+        wb.save(buf)
+    buf.seek(0)
+    return buf.getvalue()
+
+def to_xlsx(df: pd.DataFrame) -> bytes:
+    return to_xlsx_book({"Sheet1": df})
+
 # ═══════════ TEMPLATE ═══════════
 TEMPLATE_COLS = ["Numéro de compte", "Raison sociale", "Adresse", "ManagingBranch"]
+STR_DTYPE = "string[pyarrow]"  # chaînes Arrow : les .str.* tournent sur des buffers contigus
 
 example_row = {
     "Numéro de compte": "1234567",
@@ -54,21 +114,23 @@ example_row = {
     "ManagingBranch":   "0123",
 }
 
-tpl_display = pd.DataFrame([example_row])
+@st.cache_data
+def _template_display() -> pd.DataFrame:
+    return pd.DataFrame([example_row])
 
-tpl_buffer = io.BytesIO()
-(pd.DataFrame([{c: "" for c in TEMPLATE_COLS}])
-    .to_excel(tpl_buffer, index=False, engine="openpyxl"))
-tpl_buffer.seek(0)
+@st.cache_resource
+def _template_bytes() -> bytes:
+    # constant immuable : sérialisé une fois par process, partagé sans copie entre sessions
+    return to_xlsx(pd.DataFrame(columns=TEMPLATE_COLS))
 
 with st.expander("📑 Template dfrecu.xlsx"):
     st.download_button(
         "📥 Télécharger le template",
-        data=tpl_buffer.getvalue(),
+        data=_template_bytes(),
         file_name="dfrecu_template.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
-    st.dataframe(tpl_display, use_container_width=True)
+    st.dataframe(_template_display(), use_container_width=True)
 
 # ═══════════ UPLOAD & PARAMS ═══════════
 up_file = st.file_uploader("📄 Fichier dfrecu", type=("csv", "xlsx", "xls"))
@@ -92,44 +154,122 @@ if pc_enabled == "True":
 
 # ═══════════ UTILS ═══════════
 
-def read_any(f):
-    name = f.name.lower()
-    if name.endswith(".csv"):
-        for enc in ("utf-8", "latin1", "cp1252"):
+def sniff_encoding(head: bytes, truncated: bool) -> str:
+    if head.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return "utf-16"  # export « Texte Unicode » d'Excel
+    try:
+        head.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        if truncated and e.reason == "unexpected end of data":
+            return "utf-8"  # caractère multi-octets coupé par l'échantillon
+    try:
+        head.decode("cp1252")
+        return "cp1252"
+    except UnicodeDecodeError:
+        return "latin1"
+
+def sniff_sep(header: str) -> str:
+    # séparateur le plus fréquent de la ligne d'en-tête (« Texte Unicode » d'Excel = tabulations)
+    return max((",", ";", "\t"), key=header.count)  # égalité → « , » (premier rencontré)
+
+def read_csv_fast(raw: bytes, enc: str, sep: str = ",") -> pd.DataFrame:
+    # lecteur CSV Arrow (multi-thread) ; moteur C si indisponible
+    # tout en texte : ni entier ni date inférés, les zéros de tête des codes sont conservés
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+        ro, po = pacsv.ReadOptions(encoding=enc), pacsv.ParseOptions(delimiter=sep)
+        names = pacsv.open_csv(BytesIO(raw), read_options=ro, parse_options=po).schema.names
+        co = pacsv.ConvertOptions(column_types={n: pa.string() for n in names}, strings_can_be_null=True)
+        # UTF-8 invalide → ArrowInvalid (ValueError) : le moteur C lèvera l'UnicodeDecodeError
+        tbl = pacsv.read_csv(BytesIO(raw), read_options=ro, parse_options=po, convert_options=co)
+    except (ImportError, ValueError):
+        return pd.read_csv(BytesIO(raw), encoding=enc, sep=sep, dtype=STR_DTYPE, low_memory=False)
+    return tbl.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+
+def read_any(name: str, raw: bytes) -> pd.DataFrame:
+    # octets lus une seule fois : chaque parseur reçoit son propre BytesIO, sans seek
+    if name.lower().endswith(".csv"):
+        # encodage détecté sur 64 Ko au lieu de re-parser le fichier par essai
+        enc = sniff_encoding(raw[:65536], truncated=len(raw) > 65536)
+        sep = sniff_sep(raw[:65536].decode(enc, errors="ignore").partition("\n")[0])
+        # octet non décodable après l'échantillon : cp1252 d'abord (’ « œ des exports FR), latin1 en dernier
+        for alt in dict.fromkeys((enc, "cp1252")):
             try:
-                f.seek(0)
-                return pd.read_csv(f, encoding=enc)
+                return read_csv_fast(raw, alt, sep)
             except UnicodeDecodeError:
-                f.seek(0)
-        raise ValueError("Encodage CSV non reconnu.")
+                pass
+        return read_csv_fast(raw, "latin1", sep)
+    if USE_CALAMINE:
+        # lecteur Rust : bien plus rapide qu'openpyxl, lit aussi les .xls
+        return pd.read_excel(BytesIO(raw), engine="calamine")
     try:
-        return pd.read_excel(f, engine="openpyxl")
+        return pd.read_excel(BytesIO(raw), engine="openpyxl")
     except ImportError:
-        return pd.read_excel(f, engine="xlsxwriter")
+        return pd.read_excel(BytesIO(raw), engine="xlsxwriter")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_cached(name: str, blob: bytes) -> pd.DataFrame:
+    # clé = contenu du fichier : un re-clic sur « Générer » ne re-parse pas
+    # quelques entrées suffisent (re-clics sur le même upload) : la mémoire serveur reste bornée
+    return read_any(name, blob)
+
+# voie ne commence pas par un chiffre : le moteur ne peut pas s'égarer dans le code postal
+_ADDR_RE = re.compile(r"^\s*(?P<num>\d+[A-Za-z]?)\s+(?P<voie>[^\d].*?)\s+(?P<cp>\d{5})\s+(?P<ville>.+?)\s*$")
+ADDR_KEYS = ("num", "voie", "cp", "ville", "pays")
+
+def _postal_split(addr: str) -> tuple:
+    d = {"num": "", "voie": "", "cp": "", "ville": "", "pays": "FR"}
+    for val, lab in parse_address(addr):
+        if lab == "house_number": d["num"] = val
+        elif lab in {"road", "footway", "path"}: d["voie"] = val
+        elif lab == "postcode": d["cp"] = val
+        elif lab in {"city", "town", "village", "suburb"}: d["ville"] = val
+        elif lab == "country": d["pays"] = val
+    return tuple(d[k] for k in ADDR_KEYS)
+
+ADDR_MEMO_MAX = 65536
+
+@st.cache_resource
+def _addr_memo() -> dict:
+    # chaque rerun exécute le script dans un __main__ neuf : un lru_cache de module repartirait vide
+    return {}
+
+_ADDR_MEMO = _addr_memo()
+
+def _split(addr: str) -> tuple:
+    # tuple immuable : le mémo est partagé entre sessions sans risque de mutation
+    hit = _ADDR_MEMO.get(addr)
+    if hit is not None:
+        return hit
+    # gabarit « 10 Rue de la Paix 75002 Paris » en regex, libpostal seulement pour le reste
+    m = _ADDR_RE.match(addr)
+    if m:
+        res = (m.group("num"), m.group("voie"), m.group("cp"), m.group("ville"), "FR")
+    else:
+        res = _postal_split(addr) if USE_POSTAL else ("", "", "", "", "FR")
+    if len(_ADDR_MEMO) >= ADDR_MEMO_MAX:
+        _ADDR_MEMO.clear()  # borne simple : mémoire serveur plafonnée
+    _ADDR_MEMO[addr] = res
+    return res
 
 def split_address(addr: str) -> dict:
-    if USE_POSTAL:
-        d = {"num": "", "voie": "", "cp": "", "ville": "", "pays": "FR"}
-        for val, lab in parse_address(addr or ""):
-            if lab == "house_number": d["num"] = val
-            elif lab in {"road", "footway", "path"}: d["voie"] = val
-            elif lab == "postcode": d["cp"] = val
-            elif lab in {"city", "town", "village", "suburb"}: d["ville"] = val
-            elif lab == "country": d["pays"] = val
-        return d
-    m = re.match(r"^\s*(?P<num>\d+\w?)\s+(?P<voie>.+?)\s+(?P<cp>\d{5})\s+(?P<ville>.+)$", addr or "", re.I)
-    return {"num": m.group("num") if m else "", "voie": m.group("voie") if m else "", "cp": m.group("cp") if m else "", "ville": m.group("ville") if m else "", "pays": "FR"}
+    # cellule manquante = pd.NA (colonnes string[pyarrow]) : « addr or "" » lèverait sur NA
+    return dict(zip(ADDR_KEYS, _split("" if pd.isna(addr) else addr)))
 
-def to_xlsx(df: pd.DataFrame) -> bytes:
-    buf = BytesIO()
-    try:
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            df.to_excel(w, index=False)
-    except ImportError:
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as w:
-            df.to_excel(w, index=False)
-    buf.seek(0)
-    return buf.getvalue()
+def _hash_df(d: pd.DataFrame) -> bytes:
+    return pd.util.hash_pandas_object(d, index=True).values.tobytes() + repr(list(d.columns)).encode()
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={pd.DataFrame: _hash_df})
+def export_tables(labels: list[str], tables: list[pd.DataFrame]) -> tuple[list[bytes], bytes]:
+    # sérialisations indépendantes : la compression zlib relâche le GIL
+    with ThreadPoolExecutor(max_workers=min(len(tables) + 1, os.cpu_count() or 1)) as ex:
+        book = ex.submit(to_xlsx_book, dict(zip(labels, tables)))
+        blobs = list(ex.map(to_xlsx, tables))
+        return blobs, book.result()
 
 # — Outlook helper —
 
@@ -142,38 +282,57 @@ def create_outlook_draft(attachments: list[tuple[str, bytes]], to_: str = "", su
     mail.Subject = subject
     mail.Body = body or "Bonjour,\n\nVeuillez trouver les fichiers PF en pièce jointe.\n"
 
-    temp_paths = []
-    for name, data in attachments:
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=name)
-        tmp.write(data)
-        tmp.close()
-        temp_paths.append(tmp.name)
-        mail.Attachments.Add(tmp.name)
-    mail.Display()
+    # Attachments.Add copie le fichier dans le message : le dossier peut être supprimé ensuite
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, data in attachments:
+            path = os.path.join(tmp_dir, name)
+            with open(path, "wb") as fh:
+                fh.write(data)
+            mail.Attachments.Add(path)
+        mail.Display()
 
 # ——— Sanity‑check helpers ———
 
 def sanitize_numeric(series: pd.Series, width: int):
-    s = series.astype(str).str.strip()
-    s_padded = s.apply(lambda x: x.zfill(width) if x.isdigit() and len(x) <= width else x)
-    invalid = ~s_padded.str.fullmatch(fr"\d{{{width}}}")
+    s = series.astype(STR_DTYPE).str.strip()
+    pad = s.str.isdigit().fillna(False).astype(bool) & (s.str.len() <= width)
+    s_padded = s.where(~pad, s.str.zfill(width))
+    invalid = ~(s_padded.str.isdecimal().fillna(False).astype(bool) & (s_padded.str.len() == width))
     return s_padded, invalid
 
 # ═══════════ BUILD TABLES (identique) ═══════════
 # … (fonction build_tables inchangée)
 
 # ═══════════ ACTION ═══════════
+# signature des entrées : un résultat n'est servi que tant que fichier et paramètres n'ont pas changé
+inputs_sig = (
+    (up_file.file_id, up_file.size) if up_file else None,  # id d'upload : ni copie ni hash du fichier à chaque rerun
+    entreprise, punchout_user, identity, domain, vm_choice, pc_enabled, pc_name, integration_type,
+)
+if st.session_state.get("pf_payloads", {}).get("sig") != inputs_sig:
+    st.session_state.pop("pf_payloads", None)
+
 if st.button("🚀 Générer"):
+    st.session_state.pop("pf_payloads", None)
     if not (up_file and entreprise and punchout_user and identity and (pc_enabled == "False" or pc_name)):
         st.warning("Remplissez tous les champs requis.")
         st.stop()
 
     try:
-        df_src = read_any(up_file)
+        df_src = read_cached(up_file.name, up_file.getvalue())
 
         if {"Numéro de compte", "ManagingBranch"} - set(df_src.columns):
             raise ValueError("Colonnes 'Numéro de compte' ou 'ManagingBranch' manquantes.")
 
+        # lignes entièrement vides (« ,,, » en CSV, ligne blanche au milieu d'une feuille) : écartées avant tout traitement
+        df_src = df_src.dropna(how="all")
+        if df_src.empty:
+            raise ValueError("Fichier vide : aucune ligne à traiter.")
+
+        # une cellule vide a forcé les codes Excel en float64 (1234567.0) : ré-inférés en entiers avant le texte
+        src_cols = [c for c in TEMPLATE_COLS if c in df_src.columns]
+        df_src[src_cols] = df_src[src_cols].convert_dtypes().astype(STR_DTYPE)
+
         acc_series, bad_acc = sanitize_numeric(df_src["Numéro de compte"], 7)
         man_series, bad_man = sanitize_numeric(df_src["ManagingBranch"], 4)
 
@@ -195,30 +354,57 @@ if st.button("🚀 Générer"):
         st.error(f"❌ {e}")
         st.stop()
 
-    st.success("✅ Fichiers prêts !")
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-
     labels = ["PF1", "PF2", "PF3", "PF4", "PF5"] + (["PF6"] if integration_type == "cXML" else [])
+    blobs, book = export_tables(labels, list(tables[:len(labels)]))
+
+    # conservé en session : les reruns (téléchargements, Outlook) ne refont rien
+    st.session_state["pf_payloads"] = {
+        "sig": inputs_sig,
+        "entreprise": entreprise,
+        "ts": ts,
+        "labels": labels,
+        "blobs": blobs,
+        "book": book,
+        "preview": tables[0].head(),
+    }
+
+# ═══════════ RÉSULTATS ═══════════
+if "pf_payloads" in st.session_state:
+    res = st.session_state["pf_payloads"]
+    ent, ts, labels, book = res["entreprise"], res["ts"], res["labels"], res["book"]
     files_bytes = {}
 
-    for label, df in zip(labels, tables):
-        data_bytes = to_xlsx(df)
-        files_bytes[f"{label}_{entreprise}_{ts}.xlsx"] = data_bytes
-        st.download_button(
-            f"⬇️ {label}", data=data_bytes,
-            file_name=f"{label}_{entreprise}_{ts}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+    st.success("✅ Fichiers prêts !")
+
+    # un seul classeur, un onglet par PF : un clic au lieu de six
+    st.download_button(
+        f"⬇️ {labels[0]}-{labels[-1]} (un classeur)", data=book,
+        file_name=f"PF_{ent}_{ts}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        key="dl_book",
+    )
+
+    # fichiers séparés à la demande (ce sont eux qui partent en pièces jointes Outlook)
+    with st.expander("📂 Fichiers séparés"):
+        for label, data_bytes in zip(labels, res["blobs"]):
+            files_bytes[f"{label}_{ent}_{ts}.xlsx"] = data_bytes
+            st.download_button(
+                f"⬇️ {label}", data=data_bytes,
+                file_name=f"{label}_{ent}_{ts}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"dl_{label}",
+            )
 
     st.subheader("Aperçu PF1")
-    st.dataframe(tables[0].head(), use_container_width=True)
+    st.dataframe(res["preview"], use_container_width=True)
 
     # ═════ Export Outlook ═════
     st.markdown("---")
     st.header("📧 Exporter via Outlook Desktop")
     if IS_OUTLOOK:
         dest = st.text_input("Destinataire (optionnel)")
-        subj = f"Fichiers PF – {entreprise} ({ts})"
+        subj = f"Fichiers PF – {ent} ({ts})"
         if st.button("Ouvrir un brouillon Outlook", key="outlook_btn"):
             try:
                 create_outlook_draft(